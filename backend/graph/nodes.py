@@ -1,13 +1,15 @@
 # backend/graph/nodes.py
 import logging
 from pathlib import Path
-from typing import Dict, Any
-from utils.gemini_llm import GeminiLLM
+from typing import Dict, Any, Optional
+from utils.gemini_llm import GeminiLLM, THINKING_BUDGET, output_token_budget
+from utils.profiling import timed
 
 logger = logging.getLogger(__name__)
 PROMPTS_DIR = Path(__file__).parent.parent / "prompts"
 llm = GeminiLLM()
 
+@timed("prompt_load")
 def _load_prompt(mode: str, filename: str, **kwargs) -> str:
     file_path = PROMPTS_DIR / mode / filename
     if not file_path.exists():
@@ -20,33 +22,43 @@ def _load_prompt(mode: str, filename: str, **kwargs) -> str:
         logger.exception("Prompt formatting failed for %s with kwargs %s", file_path, kwargs)
         raise
 
-def _safe_invoke(prompt: str) -> Dict[str, Any]:
+@timed("llm")
+def _safe_invoke(prompt: str, max_chars: Optional[int] = None) -> Dict[str, Any]:
     """
     Call the LLM and return a dict with a consistent shape:
-      {"text": "<result string>", "error": None}
-    If it fails, return {"text": "", "error": "<error message>"} and log the exception.
+      {"text": "<result string>", "error": None, "stats": {...}}
+    When max_chars is given, generation is capped with a max_output_tokens
+    budget derived from it and streamed so it can stop at the character limit.
+    If it fails, return {"text": "", "error": "<error message>", "stats": None}
+    and log the exception.
     """
     try:
-        res = llm.invoke(prompt)
-        # if the LLM returns a dict/object sometimes, convert to string safely
-        if isinstance(res, dict):
-            # prefer 'text' or 'output' keys if present
-            text = res.get("text") or res.get("output") or str(res)
+        if max_chars:
+            res = llm.generate_with_budget(prompt, max_chars=max_chars,
+                                           max_output_tokens=output_token_budget(max_chars),
+                                           thinking_budget=THINKING_BUDGET)
         else:
-            text = str(res or "")
-        return {"text": text, "error": None}
+            res = llm.generate_with_budget(prompt)
+        return {"text": res["text"], "error": None, "stats": res["stats"]}
     except Exception as e:
         logger.exception("LLM invocation failed")
-        return {"text": "", "error": str(e)}
+        return {"text": "", "error": str(e), "stats": None}
 
 def character_node(state: Dict[str, Any]) -> Dict[str, Any]:
     mode = state.get("mode", state.get("story_mode", "cinematic")).lower()
     desc = state.get("character_sheet") or state.get("character") or ""
+    reference = state.get("reference_character_sheet")
+    if reference:
+        desc = (f"{desc}\n\n"
+                "Reference: a character sheet written for a similar description. "
+                "Reuse what fits, but the description above takes precedence "
+                f"wherever they differ.\n{reference}")
     prompt = _load_prompt(mode, "character_prompt.txt", character_description=desc)
-    result = _safe_invoke(prompt)
+    result = _safe_invoke(prompt, state.get("max_chars"))
     # Attach results in a consistent way
     state_out = dict(state)
     state_out["character_sheet"] = result["text"]
+    state_out["_stats"] = result["stats"]
     if result["error"]:
         state_out["_error"] = {"node": "character", "message": result["error"]}
     return state_out
@@ -55,11 +67,12 @@ def outline_node(state: Dict[str, Any]) -> Dict[str, Any]:
     mode = state.get("mode", state.get("story_mode", "cinematic")).lower()
     prompt = _load_prompt(mode, "outline_prompt.txt",
                           character_sheet=state.get("character_sheet", ""))
-    result = _safe_invoke(prompt)
+    result = _safe_invoke(prompt, state.get("max_chars"))
     state_out = dict(state)
     # store what main expects: outline_text OR outline
     state_out["outline_text"] = result["text"]
     state_out["outline"] = result["text"]
+    state_out["_stats"] = result["stats"]
     if result["error"]:
         state_out["_error"] = {"node": "outline", "message": result["error"]}
     return state_out
@@ -72,12 +85,13 @@ def scene_node(state: Dict[str, Any]) -> Dict[str, Any]:
                           beat=state.get("beat", ""),
                           beat_index=state.get("beat_index", 0),
                           character_sheet=state.get("character_sheet", ""))
-    result = _safe_invoke(prompt)
+    result = _safe_invoke(prompt, state.get("max_chars"))
     state_out = dict(state)
     # store in keys main checks for (scenes / scene / scenes_text)
     state_out["scenes"] = result["text"]
     state_out["scene"] = result["text"]
     state_out["scenes_text"] = result["text"]
+    state_out["_stats"] = result["stats"]
     if result["error"]:
         state_out["_error"] = {"node": "scene", "message": result["error"]}
     return state_out
@@ -89,11 +103,12 @@ def dialogue_node(state: Dict[str, Any]) -> Dict[str, Any]:
                           beat=state.get("beat", ""),
                           beat_index=state.get("beat_index", 0),
                           character_sheet=state.get("character_sheet", ""))
-    result = _safe_invoke(prompt)
+    result = _safe_invoke(prompt, state.get("max_chars"))
     state_out = dict(state)
     state_out["dialogue"] = result["text"]
     state_out["dialogues"] = result["text"]
     state_out["dialogue_text"] = result["text"]
+    state_out["_stats"] = result["stats"]
     if result["error"]:
         state_out["_error"] = {"node": "dialogue", "message": result["error"]}
     return state_out
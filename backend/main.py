@@ -1,9 +1,15 @@
 # backend/main.py
+import hmac
+import json
 import time
 import uuid
+from contextlib import contextmanager
 from typing import Optional, Literal
-from fastapi import FastAPI, HTTPException
+import anyio.to_thread
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
 from typing import Optional, Literal, Dict, Any, List
 # import google.generativeai as genai
@@ -16,8 +22,17 @@ import os
 load_dotenv()
 
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
+# Enables /admin/profile when set; callers must send it as X-Admin-Token.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+MAX_PROFILE_SECONDS = 60
+# Frames from files under here count as app code for the sampling profiler.
+APP_ROOT = os.path.dirname(os.path.abspath(__file__)) + os.sep
 
 from graph.nodes import character_node, outline_node, scene_node, dialogue_node                    
+from utils.similarity_index import SimilarityIndex
+from utils.admission import AdmissionController, AdmissionRejected, INTERACTIVE, BULK
+from utils import profiling
+from utils.text import cut_at_sentence
 
 app = FastAPI()
 
@@ -27,6 +42,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Retry-After"],  # so the frontend can honour load shedding
 )
 
 # ---------------------------
@@ -35,11 +51,65 @@ app.add_middleware(
 SESSIONS: Dict[str, Dict[str, Any]] = {}
 
 # Limits (tunable) - INCREASED TO PREVENT CUTOFFS
+# These are passed to the nodes as generation budgets (max_output_tokens +
+# early stop on the stream); _truncate below remains as a safety net.
 MAX_CHAR_SHEET_CHARS = 5000   
 MAX_SCENE_CHARS = 5000
 MAX_DIALOGUE_CHARS = 5000
 MAX_OUTLINE_BEAT_SENTENCE_CHARS = 2500
 
+# Opt-in near-duplicate cache over initial character descriptions (per mode).
+#   off   - disabled (default)
+#   reuse - return the matching session's character sheet / outline as-is;
+#           only for descriptions with the same normalized words (exact
+#           lookup), since e.g. "named Sam" vs "named Sara" is ~0.9 similar
+#   seed  - pass the matching character sheet to character_node as a
+#           reference alongside this session's own description
+SIMILARITY_CACHE = os.getenv("SIMILARITY_CACHE", "off").lower()
+SIMILARITY_INDEX: Optional[SimilarityIndex] = None
+if SIMILARITY_CACHE in ("reuse", "seed"):
+    SIMILARITY_INDEX = SimilarityIndex(
+        # used by seed only; reuse matches exact normalized tokens
+        threshold=float(os.getenv("SIMILARITY_CACHE_THRESHOLD", "0.7")),
+        max_entries=int(os.getenv("SIMILARITY_CACHE_MAX_ENTRIES", "10000")),
+    )
+# session id -> {"key": matched index key, "used": [...]}; kept server-side so
+# one user's session id never appears in another user's state.
+SIMILARITY_MATCHES: Dict[str, Dict[str, Any]] = {}
+
+# Admission control / load shedding in front of the generation endpoints.
+# Interactive single steps (/next, /step) are always favoured over bulk
+# auto-generation (/generate_full).
+ADMISSION = AdmissionController(
+    max_inflight=int(os.getenv("ADMISSION_MAX_INFLIGHT", "8")),
+    max_queue=int(os.getenv("ADMISSION_MAX_QUEUE", "16")),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "10")),
+    client_concurrency=int(os.getenv("ADMISSION_CLIENT_CONCURRENCY", "2")),
+    client_rate_per_min=float(os.getenv("ADMISSION_CLIENT_RATE_PER_MIN", "30")),
+    client_burst=int(os.getenv("ADMISSION_CLIENT_BURST", "10")),
+)
+# Sync endpoints run on anyio's worker threads (40 by default) and queued
+# requests hold a worker while they wait for a slot. The pool must cover every
+# running + queued request plus headroom for rejections, the read-only
+# endpoints and /admin/profile; otherwise requests pile up in anyio's own
+# unbounded queue before admission can shed them.
+THREADPOOL_HEADROOM = 16
+
+@app.on_event("startup")
+async def _size_threadpool():
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    needed = ADMISSION.max_inflight + ADMISSION.max_queue + THREADPOOL_HEADROOM
+    if limiter.total_tokens < needed:
+        limiter.total_tokens = needed
+
+# Quotas are per client: an allow-listed X-API-Key, otherwise the caller's IP.
+# Unknown keys are ignored so they can't be rotated to mint fresh quotas.
+ADMISSION_API_KEYS = [k.strip() for k in os.getenv("ADMISSION_API_KEYS", "").split(",") if k.strip()]
+# Number of reverse proxies in front of the app that append to
+# X-Forwarded-For (1 on Render/Heroku). With 0 the socket peer is used, which
+# behind a proxy is the proxy itself, so every user would share one quota.
+TRUSTED_PROXY_HOPS = int(os.getenv("TRUSTED_PROXY_HOPS", "0"))
+
 # ---------------------------
 # Pydantic request models
 # ---------------------------
@@ -84,10 +154,13 @@ def _make_session(mode: str, initial_desc: str) -> Dict[str, Any]:
         "last_action": None,  # None | "character" | "outline" | "scene" | "dialogue"
         # temporary user override / instruction (consumed on next generation)
         "user_override": None,
+        # per-node LLM usage: tokens generated vs kept after the char budget
+        "generation_stats": {},
     }
     SESSIONS[session_id] = session
     return session
 
+@profiling.timed("parse_outline")
 def _parse_outline_to_beats(outline_text: str) -> List[str]:
     """
     Try to split outline text into beats.
@@ -114,19 +187,137 @@ def _parse_outline_to_beats(outline_text: str) -> List[str]:
         return beats
     return [outline_text.strip()]
 
+@profiling.timed("truncate")
 def _truncate(text: str, max_chars: int) -> str:
     if not text:
         return text
     if len(text) <= max_chars:
         return text
-    cut = text[:max_chars]
-    last_newline = cut.rfind('\n')
-    if last_newline > max_chars // 2:
-        return cut[:last_newline].rstrip() + "..."
-    last_period = cut.rfind('.')
-    if last_period > max_chars // 2:
-        return cut[:last_period+1].rstrip() + "..."
-    return cut.rstrip() + "..."
+    return cut_at_sentence(text, max_chars) + "..."
+
+def _record_stats(session: Dict[str, Any], node: str, out_state: Any) -> None:
+    """Accumulate a node call's generated-vs-kept stats into the session."""
+    stats = out_state.get("_stats") if isinstance(out_state, dict) else None
+    if not stats:
+        return
+    totals = session.setdefault("generation_stats", {}).setdefault(node, {
+        "calls": 0,
+        "stopped_early": 0,
+        "tokens_generated": 0,
+        "tokens_kept": 0,
+        "tokens_thinking": 0,
+        "tokens_billed": 0,
+        "chars_generated": 0,
+        "chars_kept": 0,
+        "latency_s": 0.0,
+    })
+    totals["calls"] += 1
+    totals["stopped_early"] += int(bool(stats.get("stopped_early")))
+    for k in ("tokens_generated", "tokens_kept", "tokens_thinking", "tokens_billed",
+              "chars_generated", "chars_kept"):
+        totals[k] += stats.get(k) or 0
+    totals["latency_s"] = round(totals["latency_s"] + (stats.get("latency_s") or 0.0), 3)
+    totals["last"] = stats
+
+def _similarity_cached(session: Dict[str, Any], field: str) -> Optional[str]:
+    """
+    Return a past session's `field` if its initial description is a near
+    duplicate of this one. Each field is served from the cache at most once
+    per session, so explicitly regenerating a step always calls the LLM.
+    """
+    if SIMILARITY_INDEX is None or session.get("user_override"):
+        return None
+    desc = session.get("character_description")
+    if not desc:
+        return None
+    if session["id"] not in SIMILARITY_MATCHES:
+        if SIMILARITY_CACHE == "reuse":
+            exact = SIMILARITY_INDEX.lookup_exact(session["mode"], desc)
+            hit = None if exact is None else (exact[0], exact[1], 1.0)
+        else:
+            hit = SIMILARITY_INDEX.lookup(session["mode"], desc)
+        SIMILARITY_MATCHES[session["id"]] = {"key": hit[0] if hit else None, "used": []}
+        session["similarity_match"] = None if hit is None else {
+            "similarity": round(hit[2], 3),
+            "policy": SIMILARITY_CACHE,
+        }
+    match = SIMILARITY_MATCHES[session["id"]]
+    if match["key"] is None or field in match["used"]:
+        return None
+    cached = SIMILARITY_INDEX.get(match["key"]) or {}
+    if not cached.get(field):
+        return None
+    # An outline only fits the character sheet it was written for.
+    if field == "outline_text" and cached.get("character_sheet") != session.get("character_sheet"):
+        return None
+    match["used"].append(field)
+    return cached[field]
+
+def _similarity_store(session: Dict[str, Any], with_outline: bool) -> None:
+    """
+    Index this session's description -> freshly generated sheet/outline.
+    After a character (re)generation the session's outline was written for
+    the previous sheet, so it is only stored when with_outline is set.
+    """
+    if SIMILARITY_INDEX is None or session.get("user_override"):
+        return
+    desc = session.get("character_description")
+    if not desc:
+        return
+    SIMILARITY_INDEX.insert(session["id"], session["mode"], desc, {
+        "character_sheet": session.get("character_sheet", ""),
+        "outline_text": session.get("outline_text", "") if with_outline else "",
+    })
+
+def _client_ip(request: Request) -> str:
+    """
+    The caller's IP. Behind N trusted proxies (Render/Heroku: 1) the real
+    client is the Nth address from the right of X-Forwarded-For; anything
+    further left is client-supplied and can't be trusted.
+    """
+    if TRUSTED_PROXY_HOPS:
+        forwarded = [h.strip() for h in request.headers.get("x-forwarded-for", "").split(",") if h.strip()]
+        if len(forwarded) >= TRUSTED_PROXY_HOPS:
+            return forwarded[-TRUSTED_PROXY_HOPS]
+    return request.client.host if request.client else "unknown"
+
+def _client_id(request: Request) -> str:
+    api_key = request.headers.get("x-api-key")
+    if api_key and any(hmac.compare_digest(api_key.encode(), k.encode()) for k in ADMISSION_API_KEYS):
+        return f"key:{api_key}"
+    return f"ip:{_client_ip(request)}"
+
+@contextmanager
+def _admitted(request: Request, priority: str):
+    """Hold an admission slot for the duration of the block, or fail fast with 429/503."""
+    try:
+        with profiling.phase("admission_wait"):
+            ticket = ADMISSION.acquire(_client_id(request), priority)
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=e.status_code, detail=e.detail,
+                            headers={"Retry-After": str(e.retry_after)})
+    try:
+        yield
+    finally:
+        ADMISSION.release(ticket)
+
+def _run_admitted(request: Request, priority: str, fn, *args) -> Dict[str, Any]:
+    """
+    Run fn(*args) under an admission slot; if the caller asked for it
+    (X-Profile header or ?profile=1), attach a per-phase timing breakdown,
+    including time spent queued for the slot, to the response as "timings".
+    """
+    flag = request.headers.get("x-profile") or request.query_params.get("profile")
+    if flag not in ("1", "true", "yes"):
+        with _admitted(request, priority):
+            return fn(*args)
+    with profiling.collect() as timings:
+        with _admitted(request, priority):
+            result = fn(*args)
+        with profiling.phase("serialize"):
+            json.dumps(jsonable_encoder(result))
+    result["timings"] = timings.summary()
+    return result
 
 # ---------------------------
 # Generation Logic Helpers
@@ -135,14 +326,23 @@ def _run_character_gen(session: Dict[str, Any]) -> str:
     if not session.get("character_sheet"):
         session["character_sheet"] = session.get("character_description", "")
 
+    cached = _similarity_cached(session, "character_sheet")
+    if cached and SIMILARITY_CACHE == "reuse":
+        session["character_sheet"] = cached
+        return cached
+
     state_input = {
         "mode": session["mode"],
         "character": session["character_sheet"],
         "character_sheet": session["character_sheet"],
+        # seed: a similar past sheet, given to the prompt as reference only
+        "reference_character_sheet": cached,
         "user_override": session.get("user_override"),
+        "max_chars": MAX_CHAR_SHEET_CHARS,
     }
 
     out_state = character_node(state_input)
+    _record_stats(session, "character", out_state)
 
     if isinstance(out_state, dict) and out_state.get("_error"):
         err = out_state["_error"]
@@ -157,16 +357,25 @@ def _run_character_gen(session: Dict[str, Any]) -> str:
 
     gen = _truncate(gen, MAX_CHAR_SHEET_CHARS)
     session["character_sheet"] = gen
+    _similarity_store(session, with_outline=False)
     return gen
 
 def _run_outline_gen(session: Dict[str, Any]) -> str:
+    if SIMILARITY_CACHE == "reuse":
+        cached = _similarity_cached(session, "outline_text")
+        if cached:
+            _set_outline(session, cached)
+            return cached
+
     state_input = {
         "mode": session["mode"],
         "character_sheet": session.get("character_sheet", ""),
         "user_override": session.get("user_override"),
+        "max_chars": MAX_CHAR_SHEET_CHARS * 2,
     }
 
     out_state = outline_node(state_input)
+    _record_stats(session, "outline", out_state)
 
     if isinstance(out_state, dict) and out_state.get("_error"):
         err = out_state["_error"]
@@ -180,12 +389,15 @@ def _run_outline_gen(session: Dict[str, Any]) -> str:
     )
 
     outline_text = _truncate(outline_text, MAX_CHAR_SHEET_CHARS * 2)
-    session["outline_text"] = outline_text
+    _set_outline(session, outline_text)
+    _similarity_store(session, with_outline=True)
+    return outline_text
 
+def _set_outline(session: Dict[str, Any], outline_text: str) -> None:
+    session["outline_text"] = outline_text
     beats = _parse_outline_to_beats(outline_text)
     beats = [_truncate(b, MAX_OUTLINE_BEAT_SENTENCE_CHARS) for b in beats]
     session["outline_beats"] = beats
-    return outline_text
 
 
 # ---------------------------
@@ -214,12 +426,16 @@ def get_session(session_id: str):
 def delete_session(session_id: str):
     if session_id in SESSIONS:
         del SESSIONS[session_id]
+        SIMILARITY_MATCHES.pop(session_id, None)
         return {"status": "deleted"}
     raise HTTPException(status_code=404, detail="Session not found")
 
 # Main interactive endpoint - advances exactly one generation step
 @app.post("/session/{session_id}/next")
-def generate_next(session_id: str, req: NextRequest = NextRequest()):
+def generate_next(session_id: str, request: Request, req: NextRequest = NextRequest()):
+    return _run_admitted(request, INTERACTIVE, _generate_next, session_id, req)
+
+def _generate_next(session_id: str, req: NextRequest = NextRequest()):
     session = SESSIONS.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -296,9 +512,11 @@ def generate_next(session_id: str, req: NextRequest = NextRequest()):
                     "beat_index": si,
                     "character_sheet": session.get("character_sheet"),
                     "user_override": session.get("user_override"),
+                    "max_chars": MAX_SCENE_CHARS,
                 }
 
                 out_state = scene_node(state_input)
+                _record_stats(session, "scene", out_state)
 
                 if isinstance(out_state, dict) and out_state.get("_error"):
                     err = out_state["_error"]
@@ -342,9 +560,11 @@ def generate_next(session_id: str, req: NextRequest = NextRequest()):
                     "beat_index": si,
                     "character_sheet": session.get("character_sheet"),
                     "user_override": session.get("user_override"),
+                    "max_chars": MAX_DIALOGUE_CHARS,
                 }
 
                 out_state = dialogue_node(state_input)
+                _record_stats(session, "dialogue", out_state)
 
                 if isinstance(out_state, dict) and out_state.get("_error"):
                     err = out_state["_error"]
@@ -396,7 +616,10 @@ def generate_next(session_id: str, req: NextRequest = NextRequest()):
 
 
 @app.post("/session/{session_id}/step")
-def manual_step(session_id: str, req: StepRequest):
+def manual_step(session_id: str, req: StepRequest, request: Request):
+    return _run_admitted(request, INTERACTIVE, _manual_step, session_id, req)
+
+def _manual_step(session_id: str, req: StepRequest):
     session = SESSIONS.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -407,28 +630,31 @@ def manual_step(session_id: str, req: StepRequest):
         session["current_step"] = 0
         session["last_action"] = None
         SESSIONS[session_id] = session
-        return generate_next(session_id, NextRequest(user_input=None))
+        return _generate_next(session_id, NextRequest(user_input=None))
     if step == "outline":
         session["current_step"] = 1
         session["last_action"] = None
         SESSIONS[session_id] = session
-        return generate_next(session_id, NextRequest(user_input=None))
+        return _generate_next(session_id, NextRequest(user_input=None))
     if step == "scenes":
         session["current_step"] = 2
         session["last_action"] = None  # ensure next is scene
         SESSIONS[session_id] = session
-        return generate_next(session_id, NextRequest(user_input=None))
+        return _generate_next(session_id, NextRequest(user_input=None))
     if step == "dialogue":
         session["current_step"] = 2
         session["last_action"] = "scene"  # force dialogue next
         SESSIONS[session_id] = session
-        return generate_next(session_id, NextRequest(user_input=None))
+        return _generate_next(session_id, NextRequest(user_input=None))
 
     raise HTTPException(status_code=400, detail="Invalid step name")
 
-# Auto-generate full story: repeatedly call internal generate_next until finished.
+# Auto-generate full story: repeatedly call internal _generate_next until finished.
 @app.post("/session/{session_id}/generate_full")
-def generate_full(session_id: str):
+def generate_full(session_id: str, request: Request):
+    return _run_admitted(request, BULK, _generate_full, session_id)
+
+def _generate_full(session_id: str):
     session = SESSIONS.get(session_id)
     if not session:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -441,13 +667,13 @@ def generate_full(session_id: str):
     while iterations < max_iterations:
         iterations += 1
         try:
-            resp = generate_next(session_id, NextRequest(user_input=None))
+            resp = _generate_next(session_id, NextRequest(user_input=None))
         except HTTPException as he:
             # bubble up the node error in the outputs so the frontend can display it
             return {"status": "error", "message": "generation failed", "detail": he.detail, "state": SESSIONS.get(session_id)}
         except Exception as e:
             return {"status": "error", "message": "unexpected error", "detail": str(e), "state": SESSIONS.get(session_id)}
-        # If generate_next returns finished shape (it returned dict with status finished)
+        # If _generate_next returns finished shape (it returned dict with status finished)
         if isinstance(resp, dict) and resp.get("status") in ("finished", "ok") and resp.get("message") == "All beats processed":
             outputs.append({"status": "finished"})
             break
@@ -468,6 +694,33 @@ def generate_full(session_id: str):
 def list_sessions():
     return {"count": len(SESSIONS), "sessions": list(SESSIONS.keys())}
 
+@app.get("/similarity_cache")
+def similarity_cache_stats():
+    if SIMILARITY_INDEX is None:
+        return {"enabled": False}
+    return {"enabled": True, "policy": SIMILARITY_CACHE, **SIMILARITY_INDEX.stats()}
+
+@app.get("/admission")
+def admission_stats():
+    return ADMISSION.stats()
+
+# Sample busy threads for N seconds (?include_idle=1 adds parked ones, ?app_only=1
+# keeps request handlers only); returns collapsed stacks for flamegraph.pl / speedscope.
+@app.post("/admin/profile", response_class=PlainTextResponse)
+def admin_profile(request: Request, seconds: float = 10.0, include_idle: bool = False,
+                  app_only: bool = False):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404, detail="Not found")
+    if not hmac.compare_digest(request.headers.get("x-admin-token", "").encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds must be in (0, {MAX_PROFILE_SECONDS}]")
+    try:
+        return profiling.sample_stacks(seconds, include_idle=include_idle,
+                                       app_root=APP_ROOT, app_only=app_only)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
 # @app.post("/tts")
 # def tts_endpoint(payload: dict):
 #     import requests, traceback
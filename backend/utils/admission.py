@@ -0,0 +1,258 @@
+# backend/utils/admission.py
+import math
+import threading
+import time
+from typing import Any, Dict, Optional
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is shed; maps directly onto an HTTP error."""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class _TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.monotonic()
+
+    def take(self) -> float:
+        """Consume a token; return 0 on success, else seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def refund(self) -> None:
+        self.tokens = min(self.burst, self.tokens + 1)
+
+
+class AdmissionController:
+    """
+    Gate in front of the LLM-backed endpoints.
+
+    At most max_inflight requests run at once; up to max_queue more may wait
+    for queue_timeout seconds, after which they are shed with 503. Bulk
+    requests (auto-generation) may only hold bulk_max_inflight slots, are
+    never admitted while interactive requests are waiting, and are shed once
+    the queue is half full. Each client is limited to client_concurrency
+    running-or-queued requests and a token-bucket request rate (429); a
+    client_rate_per_min of 0 disables the rate limit. Requests shed for
+    overload don't use up the client's rate allowance.
+
+    Shedding early keeps the admitted requests within their latency budget,
+    so completed work per second stays flat under overload instead of every
+    request timing out together.
+    """
+
+    def __init__(self, max_inflight: int = 8, max_queue: int = 16, queue_timeout: float = 10.0,
+                 bulk_max_inflight: Optional[int] = None, client_concurrency: int = 2,
+                 client_rate_per_min: float = 30.0, client_burst: int = 10):
+        if max_inflight < 1 or max_queue < 0 or client_concurrency < 1:
+            raise ValueError("max_inflight and client_concurrency must be >= 1, max_queue >= 0")
+        if client_rate_per_min < 0 or client_burst < 1:
+            raise ValueError("client_rate_per_min must be >= 0 and client_burst >= 1")
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.bulk_max_inflight = bulk_max_inflight if bulk_max_inflight is not None else max(1, max_inflight // 2)
+        self.client_concurrency = client_concurrency
+        self.client_rate = client_rate_per_min / 60.0
+        self.client_burst = client_burst
+
+        self._cond = threading.Condition()
+        self._inflight = {INTERACTIVE: 0, BULK: 0}
+        self._waiting = {INTERACTIVE: 0, BULK: 0}
+        self._client_active: Dict[str, int] = {}
+        self._buckets: Dict[str, _TokenBucket] = {}
+        # EWMA of request service time, used to size Retry-After
+        self._service_s = 5.0
+        self.admitted = 0
+        self.completed = 0
+        self.rejected = {"client_concurrency": 0, "client_rate": 0, "queue_full": 0, "queue_timeout": 0}
+
+    # ---------------------------
+    # Helpers (call with lock held)
+    # ---------------------------
+    def _total_inflight(self) -> int:
+        return self._inflight[INTERACTIVE] + self._inflight[BULK]
+
+    def _total_waiting(self) -> int:
+        return self._waiting[INTERACTIVE] + self._waiting[BULK]
+
+    def _can_run(self, priority: str) -> bool:
+        if self._total_inflight() >= self.max_inflight:
+            return False
+        if priority == BULK:
+            return self._inflight[BULK] < self.bulk_max_inflight and self._waiting[INTERACTIVE] == 0
+        return True
+
+    def _retry_after(self) -> int:
+        backlog = self._total_waiting() + 1
+        return max(1, math.ceil(backlog * self._service_s / self.max_inflight))
+
+    def _client_done(self, client_id: str) -> None:
+        self._client_active[client_id] -= 1
+        if not self._client_active[client_id]:
+            del self._client_active[client_id]
+
+    def _reject(self, reason: str, status_code: int, detail: str, retry_after: int) -> AdmissionRejected:
+        self.rejected[reason] += 1
+        return AdmissionRejected(status_code, detail, retry_after)
+
+    # ---------------------------
+    # Public API
+    # ---------------------------
+    def acquire(self, client_id: str, priority: str = INTERACTIVE) -> Dict[str, Any]:
+        """Block until admitted and return a ticket for release(), or raise AdmissionRejected."""
+        with self._cond:
+            if self._client_active.get(client_id, 0) >= self.client_concurrency:
+                raise self._reject("client_concurrency", 429,
+                                   "Too many concurrent requests for this client", self._retry_after())
+
+            must_queue = not self._can_run(priority)
+            if must_queue:
+                queue_limit = self.max_queue if priority == INTERACTIVE else self.max_queue // 2
+                if self._total_waiting() >= queue_limit:
+                    raise self._reject("queue_full", 503, "Server overloaded, try again later",
+                                       self._retry_after())
+
+            bucket = None
+            if self.client_rate > 0:
+                bucket = self._buckets.get(client_id)
+                if bucket is None:
+                    if len(self._buckets) > 10000:
+                        self._prune_buckets()
+                    bucket = self._buckets[client_id] = _TokenBucket(self.client_rate, self.client_burst)
+                wait = bucket.take()
+                if wait:
+                    raise self._reject("client_rate", 429, "Request rate limit exceeded", math.ceil(wait))
+
+            if must_queue:
+                self._client_active[client_id] = self._client_active.get(client_id, 0) + 1
+                self._waiting[priority] += 1
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while not self._can_run(priority):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._client_done(client_id)
+                            if bucket is not None:
+                                # Shed for overload, not for this client's rate.
+                                bucket.refund()
+                            raise self._reject("queue_timeout", 503, "Server overloaded, try again later",
+                                               self._retry_after())
+                        self._cond.wait(remaining)
+                finally:
+                    self._waiting[priority] -= 1
+                    # Whoever we were blocking (e.g. bulk behind interactive) may now proceed.
+                    self._cond.notify_all()
+            else:
+                self._client_active[client_id] = self._client_active.get(client_id, 0) + 1
+
+            self._inflight[priority] += 1
+            self.admitted += 1
+            return {"client_id": client_id, "priority": priority, "started": time.monotonic()}
+
+    def release(self, ticket: Dict[str, Any]) -> None:
+        with self._cond:
+            self._inflight[ticket["priority"]] -= 1
+            self._client_done(ticket["client_id"])
+            elapsed = time.monotonic() - ticket["started"]
+            if ticket["priority"] == INTERACTIVE:
+                self._service_s = 0.8 * self._service_s + 0.2 * elapsed
+            self.completed += 1
+            self._cond.notify_all()
+
+    def _prune_buckets(self) -> None:
+        """Drop buckets of idle clients whose allowance has fully refilled."""
+        now = time.monotonic()
+        for cid, b in list(self._buckets.items()):
+            if cid not in self._client_active and b.tokens + (now - b.stamp) * b.rate >= b.burst:
+                del self._buckets[cid]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                "inflight": dict(self._inflight),
+                "queued": dict(self._waiting),
+                "max_inflight": self.max_inflight,
+                "max_queue": self.max_queue,
+                "bulk_max_inflight": self.bulk_max_inflight,
+                "avg_service_s": round(self._service_s, 3),
+                "admitted": self.admitted,
+                "completed": self.completed,
+                "rejected": dict(self.rejected),
+            }
+
+
+# ---------------------------
+# Overload simulation
+#   python -m utils.admission
+# Threads offer load at multiples of capacity against a sleep-based service;
+# goodput counts requests that finish within the client's deadline.
+# ---------------------------
+def _simulate(controller: Optional[AdmissionController], offered_rps: float, service_s: float,
+              deadline_s: float, duration_s: float) -> Dict[str, float]:
+    import random
+    import threading as _threading
+
+    gate = _threading.BoundedSemaphore(controller.max_inflight if controller else 8)
+    lock = _threading.Lock()
+    result = {"good": 0, "late": 0, "shed": 0}
+
+    def one(i: int) -> None:
+        start = time.monotonic()
+        ticket = None
+        if controller is not None:
+            try:
+                ticket = controller.acquire(f"c{i}", BULK if i % 5 == 0 else INTERACTIVE)
+            except AdmissionRejected:
+                with lock:
+                    result["shed"] += 1
+                return
+        with gate:  # the backend itself only serves this many at once
+            time.sleep(service_s * random.uniform(0.8, 1.2))
+        if ticket is not None:
+            controller.release(ticket)
+        with lock:
+            result["good" if time.monotonic() - start <= deadline_s else "late"] += 1
+
+    threads = []
+    end = time.monotonic() + duration_s
+    i = 0
+    while time.monotonic() < end:
+        t = _threading.Thread(target=one, args=(i,), daemon=True)
+        t.start()
+        threads.append(t)
+        i += 1
+        time.sleep(1 / offered_rps)
+    for t in threads:
+        t.join()
+    result["goodput_rps"] = round(result["good"] / duration_s, 1)
+    return result
+
+
+if __name__ == "__main__":
+    service_s, deadline_s, duration_s, slots = 0.2, 2.0, 4.0, 8
+    capacity = slots / service_s
+    print(f"capacity ~{capacity:.0f} req/s, client deadline {deadline_s}s")
+    for mult in (0.5, 1, 2, 4, 8):
+        offered = capacity * mult
+        shed = _simulate(AdmissionController(max_inflight=slots, max_queue=slots * 2, queue_timeout=1.0,
+                                             client_concurrency=1, client_rate_per_min=600, client_burst=10),
+                         offered, service_s, deadline_s, duration_s)
+        unbounded = _simulate(None, offered, service_s, deadline_s, duration_s)
+        print(f"offered {mult:>4}x  admission: {shed}  |  no admission: {unbounded}")
@@ -2,7 +2,9 @@ import google.generativeai as genai
 from langchain_core.language_models import LLM
 from typing import Optional, List, Any, Dict
 import os
+import time
 from dotenv import load_dotenv
+from utils.text import cut_at_sentence, drop_partial_sentence
 import logging
 
 load_dotenv()
@@ -25,60 +27,211 @@ class GeminiLLM(LLM):
         return "gemini"
 
     def _call(self, prompt: str, stop: Optional[List[str]] = None, **kwargs: Any) -> str:
+        return self.generate_with_budget(prompt, **kwargs)["text"]
+
+    def generate_with_budget(self, prompt: str, max_chars: Optional[int] = None,
+                             thinking_budget: Optional[int] = None, **kwargs: Any) -> Dict[str, Any]:
         """
-        Call the Gemini client. Some client versions don't accept kwargs like
-        temperature/max_output_tokens directly on generate_content(), so we:
-          1) Try passing kwargs (most flexible)
-          2) If that raises TypeError, call without kwargs (fallback)
+        Call the Gemini client and return {"text": ..., "stats": {...}}.
+
+        Generation kwargs (temperature, max_output_tokens, ...) are sent as the
+        generation_config. When max_chars is given the response is streamed and
+        we stop reading as soon as the character budget is reached, cutting the
+        text back to a clean sentence boundary. If max_output_tokens cuts the
+        answer off, the partial sentence is dropped and the stats report
+        hit_token_cap; an empty answer raises. thinking_budget is sent as a
+        thinking_config where the installed protos support it. Some client
+        versions don't accept these arguments, so on TypeError we retry with a
+        plain call.
         """
+        global _thinking_config_supported
         gen_model = genai.GenerativeModel(self.model)
+        started = time.perf_counter()
 
-        # Build request_kwargs only with keys we expect to be safe to try.
+        # Build generation_config only with keys we expect to be safe to try.
         # We'll attempt to pass them, but gracefully fall back if unsupported.
-        request_kwargs: Dict[str, Any] = {}
+        generation_config: Dict[str, Any] = {}
         for k in ("temperature", "candidate_count", "max_output_tokens", "top_k", "top_p"):
-            if k in kwargs:
-                request_kwargs[k] = kwargs[k]
+            if kwargs.get(k) is not None:
+                generation_config[k] = kwargs[k]
+
+        if thinking_budget is not None and _thinking_config_supported is not False:
+            generation_config["thinking_config"] = {"thinking_budget": thinking_budget}
+
+        stream = bool(max_chars)
+        request_kwargs: Dict[str, Any] = {}
+        if generation_config:
+            request_kwargs["generation_config"] = generation_config
+        if stream:
+            request_kwargs["stream"] = True
 
         # Attempt 1: try passing kwargs (works if client supports them)
         try:
-            if request_kwargs:
-                logger.info(f"Calling generate_content with kwargs: {list(request_kwargs.keys())}")
+            logger.info(f"Calling generate_content with kwargs: {list(request_kwargs.keys())}")
+            try:
+                response = gen_model.generate_content(prompt, **request_kwargs)
+            except ValueError as e:
+                # google-ai-generativelanguage < 0.6.18 has no thinking_config and
+                # rejects it while building the request (before any API call).
+                if "thinking_config" not in generation_config or "thinking" not in str(e):
+                    raise
+                logger.warning("Client doesn't support thinking_config; thinking is bounded "
+                               "only by max_output_tokens. Error: %s", e)
+                _thinking_config_supported = False
+                del generation_config["thinking_config"]
                 response = gen_model.generate_content(prompt, **request_kwargs)
-            else:
-                logger.info("Calling generate_content without extra kwargs (no request_kwargs found).")
-                response = gen_model.generate_content(prompt)
         except TypeError as e:
             # Some versions of the client raise TypeError for unexpected kwargs.
             logger.warning("generate_content() refused kwargs, retrying without them. Error: %s", e)
             response = gen_model.generate_content(prompt)
+            stream = False
         except Exception as e:
             # Bubble up other exceptions so they can be diagnosed (quota, auth, etc.)
             logger.exception("Error while calling Gemini generate_content: %s", e)
             raise
 
-        # Normalize response -> string
-        # Different client versions expose results differently.
+        stopped_early = False
+        stream_closed = None
+        if stream:
+            parts: List[str] = []
+            generated_chars = 0
+            usage = None
+            last_chunk = None
+            for chunk in response:
+                last_chunk = chunk
+                usage = getattr(chunk, "usage_metadata", None) or usage
+                try:
+                    piece = chunk.text or ""
+                except Exception:
+                    # Trailing chunks (finish reason / usage only) carry no parts.
+                    piece = ""
+                parts.append(piece)
+                generated_chars += len(piece)
+                if generated_chars >= max_chars:
+                    # Stop consuming the stream: everything past here would be cut anyway.
+                    stopped_early = True
+                    stream_closed = _close_stream(response)
+                    break
+            text = "".join(parts)
+            finish_reason = _finish_reason(last_chunk)
+        else:
+            usage = getattr(response, "usage_metadata", None)
+            text = _response_text(response)
+            finish_reason = _finish_reason(response)
+
+        hit_token_cap = finish_reason == "MAX_TOKENS"
+        if not text.strip():
+            raise RuntimeError(f"Gemini returned no text (finish_reason={finish_reason})")
+
+        generated = text
+        if hit_token_cap:
+            # The answer was cut off mid-stream by max_output_tokens; drop the
+            # dangling partial sentence.
+            text = drop_partial_sentence(text)
+        if max_chars:
+            text = cut_at_sentence(text, max_chars)
+
+        tokens_generated = getattr(usage, "candidates_token_count", None) or _estimate_tokens(generated)
+        tokens_kept = round(tokens_generated * len(text) / len(generated))
+        # Thinking tokens are billed as output but aren't part of the text.
+        tokens_thinking = getattr(usage, "thoughts_token_count", None) or 0
+
+        stats = {
+            "latency_s": round(time.perf_counter() - started, 3),
+            "max_output_tokens": generation_config.get("max_output_tokens"),
+            "max_chars": max_chars,
+            "streamed": stream,
+            "stopped_early": stopped_early,
+            # None = not stopped early; False = the client offered no way to
+            # cancel, so the server may keep generating (and billing) to the end.
+            "stream_closed": stream_closed,
+            "finish_reason": finish_reason,
+            "hit_token_cap": hit_token_cap,
+            "chars_generated": len(generated),
+            "chars_kept": len(text),
+            "tokens_generated": tokens_generated,
+            "tokens_kept": tokens_kept,
+            "tokens_thinking": tokens_thinking,
+            "tokens_billed": tokens_generated + tokens_thinking,
+            "thinking_capped": "thinking_config" in generation_config,
+        }
+        return {"text": text, "stats": stats}
+
+
+# Rough chars-per-token ratio for English prose; used to size output budgets
+# and to estimate token counts when the API doesn't report usage.
+CHARS_PER_TOKEN = 4
+# Gemini 2.5 models count "thinking" tokens against max_output_tokens, so each
+# budget is the visible text plus THINKING_BUDGET. Where the client supports
+# thinking_config, thinking is capped at that budget and the text always fits.
+# Otherwise (the google-ai-generativelanguage pinned by google-generativeai
+# 0.8.5) dynamic thinking may run past it; that trades occasional truncated
+# answers - dropped back to a sentence, reported as hit_token_cap, or raised
+# when nothing came back - for a max_output_tokens that actually bounds cost.
+THINKING_BUDGET = int(os.getenv("GEMINI_THINKING_BUDGET", "2048"))
+# None = not tried yet; False = the installed protos rejected thinking_config.
+_thinking_config_supported: Optional[bool] = None
+
+
+def output_token_budget(max_chars: int) -> int:
+    """Translate a character limit into a max_output_tokens budget."""
+    return -(-max_chars // CHARS_PER_TOKEN) + THINKING_BUDGET
+
+
+def _finish_reason(response: Any) -> Optional[str]:
+    """Name of the first candidate's finish reason (e.g. "STOP", "MAX_TOKENS"), if any."""
+    try:
+        reason = response.candidates[0].finish_reason
+    except Exception:
+        return None
+    if isinstance(reason, int) and not hasattr(reason, "name"):
+        # Raw proto value; 2 is FinishReason.MAX_TOKENS.
+        return {1: "STOP", 2: "MAX_TOKENS", 3: "SAFETY", 4: "RECITATION"}.get(reason, str(reason))
+    return getattr(reason, "name", None) or (str(reason) if reason else None)
+
+
+def _close_stream(response: Any) -> bool:
+    """
+    Best-effort cancel of a streamed response we've stopped reading, so the
+    server stops generating. Returns False if the client exposes no way to.
+    """
+    for target in (response, getattr(response, "_iterator", None)):
+        for method in ("cancel", "close"):
+            fn = getattr(target, method, None)
+            if callable(fn):
+                try:
+                    fn()
+                    return True
+                except Exception:
+                    logger.warning("Failed to %s Gemini stream", method, exc_info=True)
+    return False
+
+
+def _estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN) if text else 0
+
+
+def _response_text(response: Any) -> str:
+    """Normalize a non-streamed response -> string."""
+    # Different client versions expose results differently.
+    try:
+        # Newer clients often have .text
+        text = response.text
+        if isinstance(text, str) and text.strip():
+            return text
+    except Exception:
+        pass
+
+    # Fallback: some responses include candidates list/objects
+    if hasattr(response, "candidates"):
         try:
-            # Newer clients often have .text
-            text = response.text
-            if isinstance(text, str) and text.strip():
-                return text
+            candidates = response.candidates
+            joined = "\n".join([getattr(c, "text", str(c)) for c in candidates if getattr(c, "text", None)])
+            if joined.strip():
+                return joined
         except Exception:
             pass
 
-        # Fallback: some responses include candidates list/objects
-        if hasattr(response, "candidates"):
-            try:
-                candidates = response.candidates
-                joined = "\n".join([getattr(c, "text", str(c)) for c in candidates if getattr(c, "text", None)])
-                if joined.strip():
-                    return joined
-            except Exception:
-                pass
-
-        # Final fallback: try stringifying the whole response object
-        try:
-            return str(response)
-        except Exception:
-            raise RuntimeError("Could not extract text from Gemini response.")
+    # Empty, blocked or truncated-before-text responses: let the caller raise
+    # rather than storing the response repr as story text.
+    return ""
@@ -0,0 +1,160 @@
+# backend/utils/profiling.py
+import functools
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Optional
+
+# Timings collector for the current request; None when profiling is off, so
+# instrumented code pays a single ContextVar lookup and nothing else.
+_current: ContextVar[Optional["PhaseTimings"]] = ContextVar("phase_timings", default=None)
+
+
+class PhaseTimings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, Dict[str, float]] = {}
+
+    def add(self, name: str, elapsed: float) -> None:
+        entry = self.phases.setdefault(name, {"ms": 0.0, "calls": 0})
+        entry["ms"] += elapsed * 1000
+        entry["calls"] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        total_ms = (time.perf_counter() - self.started) * 1000
+        phases = {k: {"ms": round(v["ms"], 3), "calls": v["calls"]} for k, v in self.phases.items()}
+        accounted = sum(v["ms"] for v in self.phases.values())
+        return {
+            "total_ms": round(total_ms, 3),
+            "phases": phases,
+            "other_ms": round(max(0.0, total_ms - accounted), 3),
+        }
+
+
+@contextmanager
+def collect():
+    """Collect phase timings for everything run inside the block."""
+    timings = PhaseTimings()
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def _timed_phase(timings: PhaseTimings, name: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add(name, time.perf_counter() - start)
+
+
+class _NoopPhase:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP = _NoopPhase()
+
+
+def phase(name: str):
+    """Context manager timing a named phase, a shared no-op when profiling is off."""
+    timings = _current.get()
+    if timings is None:
+        return _NOOP
+    return _timed_phase(timings, name)
+
+
+def timed(name: str) -> Callable:
+    """Decorator form of phase()."""
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            timings = _current.get()
+            if timings is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                timings.add(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+# ---------------------------
+# Sampling profiler
+# ---------------------------
+_sampler_lock = threading.Lock()
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+# (file, function) of leaf frames where a thread is parked doing nothing: idle
+# threadpool workers, the event loop in select(), joins.
+_IDLE_LEAVES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+}
+
+
+def _is_app_file(filename: str, app_root: str) -> bool:
+    # A virtualenv may live inside the app directory (backend/venv).
+    return filename.startswith(app_root) and "site-packages" not in filename
+
+
+def sample_stacks(seconds: float, interval: float = 0.005, include_idle: bool = False,
+                  app_root: Optional[str] = None, app_only: bool = False) -> str:
+    """
+    Sample the stacks of other threads for `seconds` and return them in
+    collapsed-stack format ("root;...;leaf count" per line), ready for
+    flamegraph.pl or speedscope. Only one sampling run may be active at once.
+
+    Threads parked in a known idle wait are skipped unless include_idle is
+    set; a wait under app code (files inside app_root, e.g. a request queued
+    for admission) is not idle. With app_only, only threads currently running
+    app code - i.e. request handlers - are sampled.
+    """
+    if not _sampler_lock.acquire(blocking=False):
+        raise RuntimeError("A profiling run is already in progress")
+    try:
+        me = threading.get_ident()
+        counts: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                stack = []
+                in_app = False
+                while frame is not None:
+                    if app_root and _is_app_file(frame.f_code.co_filename, app_root):
+                        in_app = True
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                if app_only and not in_app:
+                    continue
+                if not include_idle and not in_app and leaf in _IDLE_LEAVES:
+                    continue
+                stack.append(names.get(ident, f"thread-{ident}"))
+                counts[";".join(reversed(stack))] += 1
+            time.sleep(interval)
+        return "".join(f"{stack} {n}\n" for stack, n in counts.most_common())
+    finally:
+        _sampler_lock.release()
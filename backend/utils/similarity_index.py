@@ -0,0 +1,323 @@
+# backend/utils/similarity_index.py
+import hashlib
+import random
+import re
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+_MASK64 = 0xFFFFFFFFFFFFFFFF
+_EMPTY = 1 << 64
+_ROTATION = 0x9E3779B97F4A7C15
+_TOKEN_RE = re.compile(r"\w+")
+
+
+def normalized_tokens(text: str) -> Tuple[str, ...]:
+    """Lower-cased word tokens, ignoring whitespace and punctuation differences."""
+    return tuple(_TOKEN_RE.findall((text or "").lower()))
+
+
+def _normalize(text: str) -> str:
+    return " ".join(normalized_tokens(text))
+
+
+def _tokens_digest(text: str) -> int:
+    data = "\x1f".join(normalized_tokens(text)).encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+class SimilarityIndex:
+    """
+    Bounded, in-memory MinHash/LSH index over short texts.
+
+    Each entry is a text (e.g. an initial character description) plus an
+    arbitrary value, stored under a caller-chosen key and a namespace (the
+    story mode). Texts are turned into character shingles, hashed into a
+    MinHash signature and split into LSH bands; lookup() returns the most
+    similar entry in the same namespace whose estimated Jaccard similarity
+    passes the threshold. lookup_exact() instead finds an entry whose text has
+    the same normalized word tokens (ignoring case, whitespace, punctuation).
+
+    Inserts are incremental, and once max_entries is reached the least
+    recently used entry is evicted. All public methods are thread-safe.
+    """
+
+    def __init__(self, threshold: float = 0.7, max_entries: int = 10000,
+                 num_perm: int = 32, bands: int = 8, shingle_size: int = 5):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        # key -> (namespace, signature, tokens digest, value); order = recency (LRU first)
+        self._entries: "OrderedDict[Any, Tuple[str, array, int, Any]]" = OrderedDict()
+        # band key -> entry key, or list of entry keys on collision
+        self._buckets: Dict[int, Any] = {}
+        # (namespace, tokens digest) -> entry key, or list of entry keys
+        self._exact: Dict[Tuple[str, int], Any] = {}
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # ---------------------------
+    # Signatures
+    # ---------------------------
+    def _shingles(self, text: str) -> set:
+        text = _normalize(text)
+        k = self.shingle_size
+        if len(text) <= k:
+            return {text}
+        return {text[i:i + k] for i in range(len(text) - k + 1)}
+
+    def signature(self, text: str) -> array:
+        """
+        One-permutation MinHash: each shingle is hashed once and only competes
+        for the minimum in one of num_perm bins, so the cost is linear in the
+        number of shingles rather than shingles * num_perm. Empty bins borrow
+        from the next non-empty bin to the right (rotation densification).
+        """
+        n = self.num_perm
+        sig = [_EMPTY] * n
+        for s in self._shingles(text):
+            h = hash(s) & _MASK64
+            b = h % n
+            v = h // n
+            if v < sig[b]:
+                sig[b] = v
+        if _EMPTY in sig:
+            filled = [i for i in range(n) if sig[i] != _EMPTY]
+            for i in range(n):
+                if sig[i] == _EMPTY:
+                    dist, j = min(((j - i) % n, j) for j in filled)
+                    sig[i] = sig[j] + dist * _ROTATION
+        return array("Q", [v & _MASK64 for v in sig])
+
+    def _band_keys(self, namespace: str, sig: array) -> List[int]:
+        r = self.rows
+        return [hash((namespace, b, tuple(sig[b * r:(b + 1) * r]))) for b in range(self.bands)]
+
+    # ---------------------------
+    # Bucket bookkeeping
+    # ---------------------------
+    @staticmethod
+    def _bucket_add(buckets: Dict[Any, Any], bucket_key: Any, key: Any) -> None:
+        cur = buckets.get(bucket_key)
+        if cur is None:
+            buckets[bucket_key] = key
+        elif isinstance(cur, list):
+            cur.append(key)
+        else:
+            buckets[bucket_key] = [cur, key]
+
+    @staticmethod
+    def _bucket_remove(buckets: Dict[Any, Any], bucket_key: Any, key: Any) -> None:
+        cur = buckets.get(bucket_key)
+        if isinstance(cur, list):
+            if key in cur:
+                cur.remove(key)
+            if len(cur) == 1:
+                buckets[bucket_key] = cur[0]
+        elif cur == key:
+            del buckets[bucket_key]
+
+    @staticmethod
+    def _bucket_keys(buckets: Dict[Any, Any], bucket_key: Any) -> List[Any]:
+        cur = buckets.get(bucket_key)
+        if cur is None:
+            return []
+        return cur if isinstance(cur, list) else [cur]
+
+    def _remove(self, key: Any) -> None:
+        namespace, sig, digest, _ = self._entries.pop(key)
+        for bk in self._band_keys(namespace, sig):
+            self._bucket_remove(self._buckets, bk, key)
+        self._bucket_remove(self._exact, (namespace, digest), key)
+
+    # ---------------------------
+    # Public API
+    # ---------------------------
+    def insert(self, key: Any, namespace: str, text: str, value: Any) -> None:
+        """Add or replace the entry stored under key."""
+        sig = self.signature(text)
+        digest = _tokens_digest(text)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (namespace, sig, digest, value)
+            for bk in self._band_keys(namespace, sig):
+                self._bucket_add(self._buckets, bk, key)
+            self._bucket_add(self._exact, (namespace, digest), key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            return None if entry is None else entry[3]
+
+    def update(self, key: Any, value: Any) -> bool:
+        """Replace the value of an existing entry without re-indexing it."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False
+            self._entries[key] = (entry[0], entry[1], entry[2], value)
+            return True
+
+    def evict(self, key: Any) -> bool:
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._remove(key)
+            self.evictions += 1
+            return True
+
+    def lookup(self, namespace: str, text: str,
+               accept: Optional[Callable[[Any, Any, float], bool]] = None) -> Optional[Tuple[Any, Any, float]]:
+        """
+        Return (key, value, similarity) for the closest entry in namespace
+        whose estimated Jaccard similarity is >= threshold, else None. If
+        accept(key, value, similarity) is given, candidates it rejects are
+        skipped; only an accepted match counts as a hit.
+        """
+        sig = self.signature(text)
+        band_keys = self._band_keys(namespace, sig)
+        with self._lock:
+            self.lookups += 1
+            candidates = set()
+            for bk in band_keys:
+                candidates.update(self._bucket_keys(self._buckets, bk))
+
+            scored = []
+            for key in candidates:
+                ns, other, _, value = self._entries[key]
+                if ns != namespace:
+                    continue
+                sim = sum(1 for a, b in zip(sig, other) if a == b) / self.num_perm
+                if sim >= self.threshold:
+                    scored.append((sim, key, value))
+
+            for sim, key, value in sorted(scored, key=lambda t: t[0], reverse=True):
+                if accept is None or accept(key, value, sim):
+                    self.hits += 1
+                    self._entries.move_to_end(key)
+                    return key, value, sim
+            return None
+
+    def lookup_exact(self, namespace: str, text: str) -> Optional[Tuple[Any, Any]]:
+        """Return (key, value) of the latest-inserted entry with the same normalized tokens, else None."""
+        digest = _tokens_digest(text)
+        with self._lock:
+            self.lookups += 1
+            keys = self._bucket_keys(self._exact, (namespace, digest))
+            if not keys:
+                return None
+            key = keys[-1]
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return key, self._entries[key][3]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "threshold": self.threshold,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "hit_rate": round(self.hits / self.lookups, 4) if self.lookups else 0.0,
+            "evictions": self.evictions,
+        }
+
+
+# ---------------------------
+# Benchmark
+#   python -m utils.similarity_index --entries 1000000
+# ---------------------------
+def _benchmark(entries: int, queries: int, edits: int) -> None:
+    import resource
+
+    rng = random.Random(42)
+    vocab = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(3, 9)))
+             for _ in range(5000)]
+
+    def make_doc() -> List[str]:
+        return [rng.choice(vocab) for _ in range(rng.randint(12, 20))]
+
+    def perturb(words: List[str]) -> List[str]:
+        words = list(words)
+        for _ in range(edits):
+            words[rng.randrange(len(words))] = rng.choice(vocab)
+        return words
+
+    index = SimilarityIndex(max_entries=entries)
+    modes = ["cinema", "novel", "comic", "drama"]
+    sample: List[Tuple[str, List[str]]] = []
+    sample_every = max(1, entries // queries)
+
+    t0 = time.perf_counter()
+    for i in range(entries):
+        mode = modes[i % len(modes)]
+        words = make_doc()
+        index.insert(i, mode, " ".join(words), i)
+        if i % sample_every == 0:
+            sample.append((mode, words))
+    insert_s = time.perf_counter() - t0
+
+    def run(docs: List[Tuple[str, str]], exact: bool) -> Tuple[int, List[float]]:
+        hits, lat = 0, []
+        for mode, text in docs:
+            t = time.perf_counter()
+            res = index.lookup_exact(mode, text) if exact else index.lookup(mode, text)
+            lat.append(time.perf_counter() - t)
+            hits += res is not None
+        return hits, lat
+
+    def reformat(words: List[str]) -> str:
+        # same words, different case / punctuation / spacing
+        return "  ".join(w.upper() if j % 3 == 0 else w + "," for j, w in enumerate(words)) + "."
+
+    near = [(m, " ".join(perturb(w))) for m, w in sample[:queries]]
+    variants = [(m, reformat(w)) for m, w in sample[:queries]]
+    fresh = [(modes[i % len(modes)], " ".join(make_doc())) for i in range(len(near))]
+
+    def pct(lat: List[float], p: float) -> float:
+        lat = sorted(lat)
+        return lat[min(len(lat) - 1, int(p * len(lat)))] * 1e6
+
+    print(f"entries:            {len(index):,} (inserted {entries:,} in {insert_s:.1f}s, "
+          f"{entries / insert_s:,.0f}/s)")
+    for policy, exact in (("seed  (LSH, threshold %.2f)" % index.threshold, False),
+                          ("reuse (exact normalized tokens)", True)):
+        near_hits, near_lat = run(near, exact)
+        variant_hits, variant_lat = run(variants, exact)
+        fresh_hits, fresh_lat = run(fresh, exact)
+        lat = near_lat + variant_lat + fresh_lat
+        print(f"{policy}:")
+        print(f"  reformatted hit rate: {variant_hits / len(variants):.3f} (case/punctuation/spacing, "
+              f"n={len(variants)})")
+        print(f"  near-dup hit rate:    {near_hits / len(near):.3f} ({edits} word edit(s), n={len(near)})")
+        print(f"  fresh false hits:     {fresh_hits / len(fresh):.3f} (n={len(fresh)})")
+        print(f"  lookup latency us:    p50={pct(lat, 0.5):.0f} p99={pct(lat, 0.99):.0f} "
+              f"max={max(lat) * 1e6:.0f}")
+    print(f"peak RSS:           {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:,.0f} MB")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark SimilarityIndex hit rate and lookup latency.")
+    parser.add_argument("--entries", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=10_000)
+    parser.add_argument("--edits", type=int, default=1, help="word substitutions per near-duplicate query")
+    args = parser.parse_args()
+    _benchmark(args.entries, args.queries, args.edits)
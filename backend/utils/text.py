@@ -0,0 +1,34 @@
+# backend/utils/text.py
+
+
+def cut_at_sentence(text: str, max_chars: int) -> str:
+    """
+    Trim text to at most max_chars, preferring to end on a line break or a
+    sentence in the second half of the budget.
+    """
+    if not text or len(text) <= max_chars:
+        return text
+    cut = text[:max_chars]
+    last_newline = cut.rfind('\n')
+    if last_newline > max_chars // 2:
+        return cut[:last_newline].rstrip()
+    last_period = cut.rfind('.')
+    if last_period > max_chars // 2:
+        return cut[:last_period+1].rstrip()
+    return cut.rstrip()
+
+
+def drop_partial_sentence(text: str) -> str:
+    """
+    Cut text that stopped mid-sentence back to its last line break or sentence
+    end, wherever it is; text with no boundary at all is returned unchanged.
+    """
+    stripped = text.rstrip()
+    if stripped.endswith(('.', '!', '?')):
+        return stripped
+    last = max(stripped.rfind(c) for c in '\n.!?')
+    if last <= 0:
+        return text
+    if stripped[last] == '\n':
+        return stripped[:last].rstrip()
+    return stripped[:last+1].rstrip()